@@ -1,10 +1,16 @@
+import io
+import math
+import mimetypes
 import os
+import shutil
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from flask import Flask, render_template, request, send_from_directory, jsonify
 from flask_socketio import SocketIO, emit
-from PIL import Image, ImageOps
-import threading
+from PIL import Image, ImageOps, features, __version__ as pillow_version
+import numpy as np
 import time
 
 # Configuration
@@ -13,11 +19,26 @@ COLLAGE_FOLDER = 'collages'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 A4_SIZE = (2480, 3508)  # Pixels at 300 DPI
 COLLAGE_INTERVAL = 60  # Seconds between collages
+# WebP when Pillow was built with libwebp, or 'jpg' for clients without WebP support
+COLLAGE_FORMAT = 'webp' if features.check('webp') else 'jpg'
+COLLAGE_SAVE_OPTIONS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    # 4:2:0 baseline JPEG, libjpeg-turbo's fastest encode path
+    'jpg': {'format': 'JPEG', 'quality': 82, 'subsampling': 2, 'optimize': False, 'progressive': False},
+}
+IMAGE_MAX_AGE = 31536000  # Seconds clients may cache served images, their names are never reused
+FOLDER_SIZE_LIMIT = 500 * 1024 * 1024  # Bytes kept in each of the upload and collage folders
+USE_X_SENDFILE = False  # Enable only behind a server that handles the X-Sendfile header
+BLANK_COLLAGE_FILENAME = f'_blank.{COLLAGE_FORMAT}'  # Pre-rendered empty collage, linked when nothing was uploaded
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your_secret_key_here'  # Change this to a random secret key
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['COLLAGE_FOLDER'] = COLLAGE_FOLDER
+app.config['USE_X_SENDFILE'] = USE_X_SENDFILE
+
+# Older Pythons don't know the WebP MIME type
+mimetypes.add_type('image/webp', '.webp')
 
 # Initialize SocketIO
 socketio = SocketIO(app, cors_allowed_origins="*")
@@ -26,10 +47,52 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(COLLAGE_FOLDER, exist_ok=True)
 
-# Store uploaded images with timestamps
-uploaded_images = []
+
+def write_collage(collage, path):
+    """Encode a collage in memory and write it to disk with as few syscalls as possible."""
+    buffer = io.BytesIO()
+    collage.save(buffer, **COLLAGE_SAVE_OPTIONS[COLLAGE_FORMAT])
+
+    data = buffer.getbuffer()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # os.write may write less than asked for
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
+# White A4 canvas, copied for every collage instead of allocating a new one
+BLANK_A4 = Image.new('RGB', A4_SIZE, color='white')
+
+# Render the blank collage once, its pixels never change
+BLANK_COLLAGE_PATH = os.path.join(COLLAGE_FOLDER, BLANK_COLLAGE_FILENAME)
+if not os.path.exists(BLANK_COLLAGE_PATH):
+    write_collage(BLANK_A4, BLANK_COLLAGE_PATH)
+
+# Single worker so collages are written to disk in the order they were made
+save_executor = ThreadPoolExecutor(max_workers=1)
+
+# Store uploaded images with monotonic timestamps, oldest first.
+# Take a list() snapshot before iterating since other threads append to it.
+uploaded_images = deque()
 last_collage_time = datetime.now()
 recent_collage = None
+last_collage_blank = False
+
+# Collage filenames, newest first
+recent_collages = deque(maxlen=100)
+
+
+def load_recent_collages():
+    """Fill recent_collages from the collages already on disk."""
+    with os.scandir(COLLAGE_FOLDER) as entries:
+        names = [entry.name for entry in entries
+                 if entry.is_file() and not entry.name.startswith('_blank.')]
+
+    # Names are timestamped, and blank collages share the template's mtime
+    recent_collages.extendleft(sorted(names))
 
 
 def allowed_file(filename):
@@ -38,51 +101,186 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def to_rgb(img):
+    """Convert an image to RGB, flattening any transparency onto white like the canvas."""
+    # Checked first, RGB images can carry a transparent color key too
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+        flattened = Image.new('RGB', img.size, color='white')
+        flattened.paste(img, mask=img.getchannel('A'))
+        return flattened
+
+    if img.mode == 'RGB':
+        return img
+
+    return img.convert('RGB')
+
+
+def create_rendition(source_path, rendition_path):
+    """
+    Save a downsampled RGB JPEG copy of an upload for building collages.
+    The copy stays just large enough to cover the whole A4 canvas.
+    """
+    with Image.open(source_path) as img:
+        # Phone photos are often stored sideways with an EXIF orientation,
+        # which the JPEG copy doesn't keep, so size for the upright image
+        sideways = img.getexif().get(0x0112, 1) in (5, 6, 7, 8)
+        width, height = (img.height, img.width) if sideways else img.size
+        scale = max(A4_SIZE[0] / width, A4_SIZE[1] / height)
+        size = (round(width * scale), round(height * scale))
+        img.draft('RGB', size[::-1] if sideways else size)
+        img = ImageOps.exif_transpose(img)
+
+        # Normalize once here so collages never convert modes, and so palette
+        # images are resampled in RGB rather than by nearest neighbour
+        img = to_rgb(img)
+
+        if scale < 1:
+            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+        img.save(rendition_path, 'JPEG', quality=85, subsampling=2)
+
+
+def _open_fit(path, size, resample=Image.LANCZOS, reducing_gap=None):
+    """
+    Open an image and fit it to size, letting JPEGs decode at reduced scale.
+    With a reducing_gap, the source is first shrunk by an integer factor so the
+    resample pass only runs over reducing_gap times the target size.
+    """
+    img = Image.open(path)
+    if reducing_gap is None:
+        # No-op for formats other than JPEG
+        img.draft('RGB', size)
+        return ImageOps.fit(img, size, resample)
+
+    img.draft('RGB', (int(size[0] * reducing_gap), int(size[1] * reducing_gap)))
+
+    # Center-crop to the target aspect ratio, like ImageOps.fit
+    width, height = img.size
+    scale = max(size[0] / width, size[1] / height)
+    crop_width = size[0] / scale
+    crop_height = size[1] / scale
+    left = (width - crop_width) / 2
+    top = (height - crop_height) / 2
+    box = (left, top, left + crop_width, top + crop_height)
+
+    return img.resize(size, resample, box=box, reducing_gap=reducing_gap)
+
+
+def expire_uploads():
+    """Drop uploaded images older than the collage interval."""
+    cutoff = time.monotonic() - COLLAGE_INTERVAL
+
+    while uploaded_images and uploaded_images[0]['timestamp'] < cutoff:
+        uploaded_images.popleft()
+
+
+def evict_oldest_files(folder, max_bytes, keep=()):
+    """Delete the least recently modified files in a folder until it fits in max_bytes."""
+    files = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # Removed since the directory was scanned
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in files)
+    files.sort()
+
+    evicted = []
+    for _, size, path in files:
+        if total <= max_bytes:
+            break
+        if path in keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted.append(os.path.basename(path))
+
+    return evicted
+
+
+def publish_collage(collage_filename, save_future=None):
+    """Broadcast a new collage to all connected clients once it is on disk."""
+    global recent_collage
+
+    if save_future is not None:
+        save_future.result()
+
+    recent_collage = collage_filename
+    recent_collages.appendleft(collage_filename)
+    socketio.emit('new_collage', {
+        'filename': collage_filename,
+        # Listed at send time, so uploads made while encoding stay visible
+        'uploaded_images': [img['name'] for img in list(uploaded_images)]
+    })
+
+
 def create_dynamic_collage():
     """
     Create a collage that dynamically fills the entire canvas based on uploaded images.
     If no images are uploaded, create a blank collage.
     """
-    global last_collage_time, recent_collage
+    global last_collage_time, last_collage_blank
 
 
     print("creating dynamic collage")
 
-    # Filter images from last 60 seconds
+    # Keep images from last 60 seconds
+    expire_uploads()
     current_time = datetime.now()
-    recent_images = [
-        img for img in uploaded_images
-        if current_time - img['timestamp'] <= timedelta(seconds=COLLAGE_INTERVAL)
-    ]
+    recent_images = list(uploaded_images)
+
+    if not recent_images and last_collage_blank:
+        # Still nothing uploaded, re-announce the previous blank collage instead of making another
+        last_collage_time = current_time
+        socketio.start_background_task(socketio.emit, 'new_collage', {
+            'filename': recent_collage,
+            'uploaded_images': []
+        })
 
-    # Create a blank A4 white background
-    collage = Image.new('RGB', A4_SIZE, color='white')
+        return recent_collage
 
     if not recent_images:
-        # Save blank collage if no images are uploaded
-        collage_filename = f"collage_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
+        # Link the pre-rendered blank collage if no images are uploaded
+        collage_filename = f"collage_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{COLLAGE_FORMAT}"
         collage_path = os.path.join(app.config['COLLAGE_FOLDER'], collage_filename)
-        collage.save(collage_path)
+        try:
+            os.link(BLANK_COLLAGE_PATH, collage_path)
+        except OSError:
+            # Filesystem without hard links, or the name is already taken
+            shutil.copyfile(BLANK_COLLAGE_PATH, collage_path)
 
-        # Update last collage time and recent collage
+        # Update last collage time
         last_collage_time = current_time
-        recent_collage = collage_filename
+        last_collage_blank = True
 
         # Broadcast the new blank collage to all connected clients
-        socketio.emit('new_collage', {
-            'filename': collage_filename,
-            'uploaded_images': []
-        })
+        socketio.start_background_task(publish_collage, collage_filename)
 
         return collage_filename
 
     # Determine layout based on number and aspect ratios of images
     num_images = len(recent_images)
 
+    # Lanczos detail is lost at grid cell sizes, bicubic needs far fewer taps per pixel
+    resample = Image.LANCZOS if num_images <= 3 else Image.BICUBIC
+
+    if num_images <= 3:
+        # Start from a copy of the blank A4 white background
+        collage = BLANK_A4.copy()
+
     if num_images == 1:
         # Single image - fill entire canvas
-        img = Image.open(recent_images[0]['path'])
-        img = ImageOps.fit(img, A4_SIZE, Image.LANCZOS)
+        img = _open_fit(recent_images[0]['path'], A4_SIZE, resample)
         collage.paste(img, (0, 0))
     elif num_images == 2:
         # Two images - split vertically
@@ -90,13 +288,11 @@ def create_dynamic_collage():
         half_width = width // 2
 
         # First image
-        img1 = Image.open(recent_images[0]['path'])
-        img1 = ImageOps.fit(img1, (half_width, A4_SIZE[1]), Image.LANCZOS)
+        img1 = _open_fit(recent_images[0]['path'], (half_width, A4_SIZE[1]), resample)
         collage.paste(img1, (0, 0))
 
         # Second image
-        img2 = Image.open(recent_images[1]['path'])
-        img2 = ImageOps.fit(img2, (width - half_width, A4_SIZE[1]), Image.LANCZOS)
+        img2 = _open_fit(recent_images[1]['path'], (width - half_width, A4_SIZE[1]), resample)
         collage.paste(img2, (half_width, 0))
     elif num_images == 3:
         # Three images - two on top, one on bottom
@@ -107,54 +303,55 @@ def create_dynamic_collage():
         top_height = height * 2 // 3
         top_width = width // 2
 
-        img1 = Image.open(recent_images[0]['path'])
-        img1 = ImageOps.fit(img1, (top_width, top_height), Image.LANCZOS)
+        img1 = _open_fit(recent_images[0]['path'], (top_width, top_height), resample)
         collage.paste(img1, (0, 0))
 
-        img2 = Image.open(recent_images[1]['path'])
-        img2 = ImageOps.fit(img2, (width - top_width, top_height), Image.LANCZOS)
+        img2 = _open_fit(recent_images[1]['path'], (width - top_width, top_height), resample)
         collage.paste(img2, (top_width, 0))
 
         # Bottom image
-        img3 = Image.open(recent_images[2]['path'])
-        img3 = ImageOps.fit(img3, (width, height - top_height), Image.LANCZOS)
+        img3 = _open_fit(recent_images[2]['path'], (width, height - top_height), resample)
         collage.paste(img3, (0, top_height))
     else:
         # 4 or more images - grid layout
         width = A4_SIZE[0]
         height = A4_SIZE[1]
 
-        import numpy as np
-        grid_size = int(np.ceil(np.sqrt(num_images)))
+        grid_size = math.isqrt(num_images - 1) + 1  # ceil(sqrt(num_images))
         cell_width = width // grid_size
         cell_height = height // grid_size
 
-        for i, img_data in enumerate(recent_images):
+        # Assemble the grid directly in a white pixel array
+        canvas = np.full((height, width, 3), 255, np.uint8)
+
+        def place_tile(i, img_data):
             row = i // grid_size
             col = i % grid_size
 
-            img = Image.open(img_data['path'])
-            img = ImageOps.fit(img, (cell_width, cell_height), Image.LANCZOS)
-
             x = col * cell_width
             y = row * cell_height
 
-            collage.paste(img, (x, y))
+            img = _open_fit(img_data['path'], (cell_width, cell_height), resample, reducing_gap=2.0)
+            canvas[y:y + cell_height, x:x + cell_width] = np.asarray(img)
 
-    # Save collage
-    collage_filename = f"collage_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
+        # Place tiles in parallel, Pillow releases the GIL while decoding and resampling
+        # and every tile writes to its own slice of the canvas
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(place_tile, range(num_images), recent_images))
+
+        collage = Image.fromarray(canvas)
+
+    # Save collage off the scheduler thread, the encoders run without the GIL
+    collage_filename = f"collage_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{COLLAGE_FORMAT}"
     collage_path = os.path.join(app.config['COLLAGE_FOLDER'], collage_filename)
-    collage.save(collage_path)
+    save_future = save_executor.submit(write_collage, collage, collage_path)
 
-    # Update last collage time and recent collage
+    # Update last collage time
     last_collage_time = current_time
-    recent_collage = collage_filename
+    last_collage_blank = False
 
-    # Broadcast the new collage to all connected clients
-    socketio.emit('new_collage', {
-        'filename': collage_filename,
-        'uploaded_images': [os.path.basename(img['path']) for img in uploaded_images]
-    })
+    # Broadcast the new collage to all connected clients once it is saved
+    socketio.start_background_task(publish_collage, collage_filename, save_future)
 
     return collage_filename
 
@@ -162,11 +359,11 @@ def create_dynamic_collage():
 
 def collage_scheduler():
     """Periodically create collages and clean up uploaded images."""
-    global uploaded_images, last_collage_time
+    global last_collage_time
 
     while True:
         print("before sleep")
-        time.sleep(COLLAGE_INTERVAL)
+        socketio.sleep(COLLAGE_INTERVAL)
 
         # Create collage
         create_dynamic_collage()
@@ -174,11 +371,18 @@ def collage_scheduler():
 
 
         # Clean up uploaded images older than interval
-        current_time = datetime.now()
-        uploaded_images = [
-            img for img in uploaded_images
-            if current_time - img['timestamp'] <= timedelta(seconds=COLLAGE_INTERVAL)
-        ]
+        expire_uploads()
+
+        # Cap disk usage, keeping the images still in use
+        evict_oldest_files(UPLOAD_FOLDER, FOLDER_SIZE_LIMIT,
+                           keep={img['path'] for img in list(uploaded_images)})
+
+        keep = {BLANK_COLLAGE_PATH}
+        if recent_collage:
+            keep.add(os.path.join(COLLAGE_FOLDER, recent_collage))
+        for filename in evict_oldest_files(COLLAGE_FOLDER, FOLDER_SIZE_LIMIT, keep):
+            if filename in recent_collages:
+                recent_collages.remove(filename)
 
         print("after cleanup")
 
@@ -188,10 +392,10 @@ def collage_scheduler():
 def index():
     """Render the main page."""
     # Get list of uploaded image filenames
-    uploaded_filenames = [os.path.basename(img['path']) for img in uploaded_images]
+    uploaded_filenames = [img['name'] for img in list(uploaded_images)]
 
     # Get list of recent collages
-    collage_files = sorted(os.listdir(app.config['COLLAGE_FOLDER']), reverse=True)
+    collage_files = list(recent_collages)
 
     return render_template('index.html',
                            uploaded_images=uploaded_filenames,
@@ -216,16 +420,25 @@ def upload_file():
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
 
+        # Downsample once here instead of on every collage tick
+        rendition_path = filepath + '.cache.jpg'
+        try:
+            create_rendition(filepath, rendition_path)
+        except (OSError, Image.DecompressionBombError):
+            os.remove(filepath)
+            return jsonify({'error': 'Invalid image file'}), 400
+
         # Store image with timestamp
         uploaded_images.append({
-            'path': filepath,
-            'timestamp': datetime.now()
+            'path': rendition_path,
+            'name': os.path.basename(rendition_path),
+            'timestamp': time.monotonic()
         })
 
         # Broadcast the new upload to all connected clients
         socketio.emit('new_upload', {
             'filename': filename,
-            'uploaded_images': [os.path.basename(img['path']) for img in uploaded_images]
+            'uploaded_images': [img['name'] for img in list(uploaded_images)]
         })
 
         return jsonify({'message': 'File uploaded successfully', 'filename': filename}), 200
@@ -240,34 +453,43 @@ def handle_connect():
     next_collage_time = last_collage_time + timedelta(seconds=COLLAGE_INTERVAL)
 
     emit('initial_state', {
-        'uploaded_images': [os.path.basename(img['path']) for img in uploaded_images],
+        'uploaded_images': [img['name'] for img in list(uploaded_images)],
         'recent_collage': recent_collage,
         'remaining_time': int(remaining_time),
         'next_collage_time': next_collage_time.isoformat()  # Send the exact next collage time
     })
 
 
+def send_immutable(directory, filename):
+    """Send a file that never changes under its name, letting clients cache it for good."""
+    response = send_from_directory(directory, filename, max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route('/uploads/<filename>')
 def serve_upload(filename):
     """Serve uploaded images."""
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_immutable(app.config['UPLOAD_FOLDER'], filename)
 
 
 @app.route('/collages/<filename>')
 def serve_collage(filename):
     """Serve saved collage images."""
-    return send_from_directory(app.config['COLLAGE_FOLDER'], filename)
+    return send_immutable(app.config['COLLAGE_FOLDER'], filename)
 
 
-def start_scheduler():
-    """Start the collage scheduler in a separate thread."""
-    scheduler_thread = threading.Thread(target=collage_scheduler, daemon=True)
-    scheduler_thread.start()
+if __name__ == '__main__':
+    # Pillow-SIMD versions carry a ".postN" suffix, stock Pillow does not
+    if 'post' not in pillow_version:
+        print(f"warning: running on stock Pillow {pillow_version}, install Pillow-SIMD for faster resizing")
 
+    # Pick up collages from previous runs
+    load_recent_collages()
 
-if __name__ == '__main__':
-    # Start the scheduler before running the app
-    start_scheduler()
+    # Start the scheduler as a SocketIO background task before running the app
+    socketio.start_background_task(collage_scheduler)
 
-    # Run the SocketIO app
-    socketio.run(app, debug=True)
\ No newline at end of file
+    # Run the SocketIO app, the debug reloader would start a second scheduler
+    socketio.run(app, debug=False)
\ No newline at end of file